@@ -3,25 +3,35 @@
 import os
 import sys
 import struct
-import subprocess
-import tempfile
+import time
+import hashlib
 from datetime import datetime
+from io import BytesIO
 import json
-import urllib.request, urllib.parse, urllib.error
-
-try:
-    from PIL import Image, ImageOps
-except ImportError:
-    sys.stderr.write("Error: The 'Pillow' library is not installed.\n")
-    sys.stderr.write("Please install it, for example: 'pip install Pillow'\n")
-    sys.exit(1)
+import gzip
+import zlib
+import urllib.parse
 
 # Constants
 API_URL = "https://api.open-meteo.com/v1/forecast"
 DAILY_VARS = "weather_code,temperature_2m_max,temperature_2m_min,precipitation_probability_max,precipitation_hours"
 FORECAST_DAYS = "1"
+ICON_SIZE = 256
+FORECAST_CACHE_TTL = 1800
+# Bump when the cached ESC-POS raster format changes, so stale blobs aren't printed.
+RASTER_CACHE_VERSION = 1
+RASTER_HEADER = b'\x1d\x76\x30\x00'
+INVERT_TABLE = bytes(255 - b for b in range(256))
+# Ordinal suffix for each day of the month, indexed by day (0 unused).
+ORDINAL_SUFFIXES = tuple(
+    {1: "st", 2: "nd", 3: "rd", 21: "st", 22: "nd", 23: "rd", 31: "st"}.get(day, "th")
+    for day in range(32)
+)
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-ICON_BASE_URL = "https://github.com/erikflowers/weather-icons/raw/refs/heads/master/svg/"
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser("~/.cache"), "print-weather")
+ICON_BASE_URL = "https://raw.githubusercontent.com/erikflowers/weather-icons/master/svg/"
+ICONS_DIR = os.path.join(SCRIPT_DIR, "weather-icons", "svg")
+DOWNLOAD_WORKERS = 8
 ICON_NAMES = [
     "wi-cloudy.svg", "wi-day-cloudy.svg", "wi-day-rain.svg",
     "wi-day-showers.svg", "wi-day-snow.svg", "wi-day-sunny.svg", "wi-fog.svg",
@@ -29,29 +39,79 @@ ICON_NAMES = [
     "wi-snow.svg", "wi-sprinkle.svg", "wi-storm-showers.svg",
     "wi-thunderstorm.svg",
 ]
+NA_ICON_PATH = ICONS_DIR + os.sep + "wi-na.svg"
+# Icon file path for each WMO weather code (0-99), indexed directly by code.
+ICON_TABLE = tuple(
+    ICONS_DIR + os.sep +
+    {
+        0: "wi-day-sunny.svg", 1: "wi-day-cloudy.svg", 2: "wi-cloudy.svg",
+        3: "wi-cloudy.svg", 45: "wi-fog.svg", 48: "wi-fog.svg",
+        51: "wi-sprinkle.svg", 53: "wi-sprinkle.svg", 55: "wi-sprinkle.svg",
+        56: "wi-sleet.svg", 57: "wi-sleet.svg", 61: "wi-day-rain.svg",
+        63: "wi-rain.svg", 65: "wi-rain.svg", 66: "wi-sleet.svg",
+        67: "wi-sleet.svg", 71: "wi-snow.svg", 73: "wi-snow.svg",
+        75: "wi-snow.svg", 77: "wi-snow.svg", 80: "wi-day-showers.svg",
+        81: "wi-showers.svg", 82: "wi-showers.svg", 85: "wi-day-snow.svg",
+        86: "wi-day-snow.svg", 95: "wi-thunderstorm.svg",
+        96: "wi-storm-showers.svg", 99: "wi-storm-showers.svg",
+    }.get(code, "wi-na.svg")
+    for code in range(100)
+)
+
+def download_icon(conn, icon_name):
+    """Downloads a single icon over an open keep-alive connection."""
+    conn.request("GET", urllib.parse.urlsplit(ICON_BASE_URL).path + icon_name)
+    response = conn.getresponse()
+    body = response.read()
+    if response.status != 200:
+        raise OSError(f"HTTP {response.status} {response.reason}")
+    with open(os.path.join(ICONS_DIR, icon_name), 'wb') as out_file:
+        out_file.write(body)
 
 def download_icons():
     """Downloads the necessary weather icons."""
-    icons_dir = os.path.join(SCRIPT_DIR, "weather-icons", "svg")
-    os.makedirs(icons_dir, exist_ok=True)
-    print(f"Downloading icons to {icons_dir}...")
-    for icon_name in ICON_NAMES:
-        url = f"{ICON_BASE_URL}{icon_name}"
-        dest_path = os.path.join(icons_dir, icon_name)
+    import http.client
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    os.makedirs(ICONS_DIR, exist_ok=True)
+    print(f"Downloading icons to {ICONS_DIR}...")
+    local = threading.local()
+    connections = []
+
+    def fetch(icon_name):
+        if not hasattr(local, "conn"):
+            local.conn = http.client.HTTPSConnection(urllib.parse.urlsplit(ICON_BASE_URL).netloc, timeout=30)
+            connections.append(local.conn)
         try:
-            sys.stdout.write(f"  Downloading {icon_name}...")
-            sys.stdout.flush()
-            with urllib.request.urlopen(url) as response, open(dest_path, 'wb') as out_file:
-                out_file.write(response.read())
-            sys.stdout.write("done.\n")
-        except urllib.error.URLError as e:
-            sys.stderr.write(f"\nError downloading {icon_name}: {e}\n")
+            download_icon(local.conn, icon_name)
+            return icon_name, None
+        except (OSError, http.client.HTTPException) as e:
+            local.conn.close()
+            return icon_name, e
+
+    try:
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            for icon_name, error in executor.map(fetch, ICON_NAMES):
+                if error:
+                    sys.stderr.write(f"Error downloading {icon_name}: {error}\n")
+                else:
+                    print(f"  Downloaded {icon_name}.")
+    finally:
+        for conn in connections:
+            conn.close()
     print("Icon download complete.")
+    print(f"Rendering icons to {CACHE_DIR}...")
+    for icon_name in ICON_NAMES:
+        icon_path = os.path.join(ICONS_DIR, icon_name)
+        if os.path.exists(icon_path) and isinstance(get_escpos_blob(icon_path, refresh=True), bytes):
+            sys.stderr.write(f"Warning: could not write {icon_name} to the cache in {CACHE_DIR}.\n")
+    print("Icon rendering complete.")
     sys.exit(0)
 
 def check_dependencies():
     """Checks for external dependencies."""
-    if not os.path.isdir(os.path.join(SCRIPT_DIR, "weather-icons", "svg")):
+    if not os.path.isdir(ICONS_DIR):
         sys.stderr.write("Error: weather-icons/svg directory not found.\n")
         sys.stderr.write(f"Please run 'printweather.py --download-icons' to download them.\n")
         sys.stderr.write("Or 'git clone https://github.com/erikflowers/weather-icons'.\n")
@@ -67,20 +127,53 @@ def get_config():
 
 def get_weather_icon_path(code):
     """Maps weather code to icon file path."""
-    icon_map = {
-        0: "wi-day-sunny.svg", 1: "wi-day-cloudy.svg", 2: "wi-cloudy.svg",
-        3: "wi-cloudy.svg", 45: "wi-fog.svg", 48: "wi-fog.svg",
-        51: "wi-sprinkle.svg", 53: "wi-sprinkle.svg", 55: "wi-sprinkle.svg",
-        56: "wi-sleet.svg", 57: "wi-sleet.svg", 61: "wi-day-rain.svg",
-        63: "wi-rain.svg", 65: "wi-rain.svg", 66: "wi-sleet.svg",
-        67: "wi-sleet.svg", 71: "wi-snow.svg", 73: "wi-snow.svg",
-        75: "wi-snow.svg", 77: "wi-snow.svg", 80: "wi-day-showers.svg",
-        81: "wi-showers.svg", 82: "wi-showers.svg", 85: "wi-day-snow.svg",
-        86: "wi-day-snow.svg", 95: "wi-thunderstorm.svg",
-        96: "wi-storm-showers.svg", 99: "wi-storm-showers.svg",
-    }
-    icon_name = icon_map.get(code, "wi-na.svg")
-    return os.path.join(SCRIPT_DIR, "weather-icons", "svg", icon_name)
+    if isinstance(code, float) and code.is_integer():
+        code = int(code)
+    if isinstance(code, int) and 0 <= code < len(ICON_TABLE):
+        return ICON_TABLE[code]
+    return NA_ICON_PATH
+
+def get_cache_path(svg_path, ext):
+    """Returns the cache path for an icon, keyed by its name, size and raster format."""
+    name = os.path.splitext(os.path.basename(svg_path))[0]
+    return CACHE_DIR + os.sep + f"{name}-{ICON_SIZE}-v{RASTER_CACHE_VERSION}{ext}"
+
+def write_cache_file(path, data):
+    """Atomically writes bytes to a file in the cache directory."""
+    import tempfile
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def parse_json(raw):
+    """Parses an API response body, using orjson when it is installed."""
+    try:
+        import orjson
+    except ImportError:
+        return json.loads(raw)
+    return orjson.loads(raw)
+
+def load_cached_forecast(cache_path):
+    """Returns the cached forecast if it is within the TTL and still for today, else None."""
+    try:
+        if time.time() - os.stat(cache_path).st_mtime >= FORECAST_CACHE_TTL:
+            return None
+        with open(cache_path, 'rb') as f:
+            cached = json.loads(f.read())
+        # Compare against today in the forecast's own timezone, not the system's.
+        today = time.strftime("%Y-%m-%d", time.gmtime(time.time() + cached['utc_offset_seconds']))
+        if cached['daily']['time'][0] != today:
+            return None
+        return cached['daily']
+    except (OSError, ValueError, KeyError, IndexError, TypeError):
+        return None
 
 def fetch_weather_data(latitude, longitude, timezone):
     """Fetches weather data from the Open-Meteo API."""
@@ -88,78 +181,153 @@ def fetch_weather_data(latitude, longitude, timezone):
         "latitude": latitude, "longitude": longitude, "daily": DAILY_VARS,
         "timezone": timezone, "forecast_days": FORECAST_DAYS,
     }
-    url = f"{API_URL}?{urllib.parse.urlencode(params)}"
-    response_text = ""
+    query = urllib.parse.urlencode(params)
+    cache_path = os.path.join(CACHE_DIR, f"forecast-{hashlib.sha256(query.encode()).hexdigest()[:16]}.json")
+    cached = load_cached_forecast(cache_path)
+    if cached is not None:
+        return cached
+
+    from urllib.request import Request, urlopen
+    from urllib.error import URLError
+
+    request = Request(f"{API_URL}?{query}", headers={"Accept-Encoding": "gzip"})
+    response_body = b""
     try:
-        with urllib.request.urlopen(url) as response:
-            response_text = response.read().decode('utf-8')
-        data = json.loads(response_text)
+        with urlopen(request) as response:
+            response_body = response.read()
+            if response.headers.get("Content-Encoding") == "gzip":
+                response_body = gzip.decompress(response_body)
+        data = parse_json(response_body)
         if "error" in data:
             sys.stderr.write(f"Error from weather API: {data}\n")
             sys.exit(1)
-        return data['daily']
-    except urllib.error.URLError as e:
+        daily = data['daily']
+        if 'utc_offset_seconds' in data:
+            cached = {'utc_offset_seconds': data['utc_offset_seconds'], 'daily': daily}
+            try:
+                write_cache_file(cache_path, json.dumps(cached).encode('utf-8'))
+            except OSError:
+                pass
+        return daily
+    except URLError as e:
         sys.stderr.write(f"Error fetching weather data: {e}\n")
         sys.exit(1)
-    except (KeyError, json.JSONDecodeError):
-        sys.stderr.write(f"Unexpected API response format: {response_text}\n")
+    except (KeyError, json.JSONDecodeError, gzip.BadGzipFile, EOFError, zlib.error):
+        sys.stderr.write(f"Unexpected API response format: {response_body.decode('utf-8', 'replace')}\n")
         sys.exit(1)
 
-def convert_svg_to_png(svg_path):
-    """Converts SVG to a temporary PNG file for printing."""
-    fd, tmp_png_path = tempfile.mkstemp(suffix=".png")
-    os.close(fd)
+def render_svg(svg_path):
+    """Renders SVG to white-backed PNG bytes using cairosvg, rsvg-convert or ImageMagick."""
+    import shutil
+    import subprocess
 
     try:
-        relative_svg_path = os.path.relpath(svg_path, SCRIPT_DIR)
-        subprocess.run(
-            [
-                "convert", "-background", "white", "-density", "900",
-                relative_svg_path, "-resize", "256x256", tmp_png_path,
-            ],
-            check=True, capture_output=True, text=True, cwd=SCRIPT_DIR
+        import cairosvg
+    except (ImportError, OSError):
+        # OSError: cairosvg is installed but the system cairo library is not.
+        cairosvg = None
+
+    if cairosvg:
+        return cairosvg.svg2png(
+            url=svg_path, output_width=ICON_SIZE,
+            output_height=ICON_SIZE, background_color="white",
         )
-        return tmp_png_path
+
+    relative_svg_path = os.path.relpath(svg_path, SCRIPT_DIR)
+    if shutil.which("rsvg-convert"):
+        command = [
+            "rsvg-convert", "-w", str(ICON_SIZE), "-h", str(ICON_SIZE),
+            "-b", "white", relative_svg_path,
+        ]
+    else:
+        command = [
+            "convert", "-background", "white", "-density", "900",
+            relative_svg_path, "-resize", f"{ICON_SIZE}x{ICON_SIZE}", "png:-",
+        ]
+    return subprocess.run(command, check=True, capture_output=True, cwd=SCRIPT_DIR).stdout
+
+def render_svg_to_escpos(svg_path):
+    """Renders SVG to an ESC-POS raster bit image command without touching disk."""
+    import subprocess
+    try:
+        from PIL import Image
+    except ImportError:
+        sys.stderr.write("Error: The 'Pillow' library is not installed.\n")
+        sys.stderr.write("Please install it, for example: 'pip install Pillow'\n")
+        sys.exit(1)
+
+    if not os.path.isfile(svg_path):
+        sys.stderr.write(f"Error: weather icon not found: {svg_path}\n")
+        sys.stderr.write("Please run 'printweather.py --download-icons' to download it.\n")
+        sys.exit(1)
+
+    try:
+        png = render_svg(svg_path)
     except FileNotFoundError:
-        sys.stderr.write("Error: 'convert' command not found. ImageMagick is required.\n")
-        sys.stderr.write("Please install ImageMagick.\n")
-        os.remove(tmp_png_path)
+        sys.stderr.write("Error: no SVG renderer found. rsvg-convert or ImageMagick is required.\n")
+        sys.stderr.write("Please install librsvg (rsvg-convert), ImageMagick, or 'pip install cairosvg'.\n")
         sys.exit(1)
     except subprocess.CalledProcessError as e:
-        sys.stderr.write(f"Error converting SVG to PNG: {e.stderr}\n")
-        os.remove(tmp_png_path)
+        sys.stderr.write(f"Error converting SVG to PNG: {e.stderr.decode('utf-8', 'replace')}\n")
         sys.exit(1)
 
-def print_image_and_cleanup(image_path):
-    """Prints a raster image to an ESC-POS printer and cleans up the file."""
-    try:
-        im = Image.open(image_path)
-        im = im.transpose(Image.FLIP_TOP_BOTTOM)
-        if im.mode != '1':
-            im = im.convert('1')
-        if im.size[0] % 8:
-            im2 = Image.new('1', (im.size[0] + 8 - im.size[0] % 8, im.size[1]), 'white')
-            im2.paste(im, (0, 0))
-            im = im2
-        im = ImageOps.invert(im.convert('L'))
-        im = im.convert('1')
-
-        header = b'\x1d\x76\x30\x00'
-        width_bytes = struct.pack('2B', int(im.size[0] / 8) % 256, int(im.size[0] / (8 * 256)))
-        height_bytes = struct.pack('2B', im.size[1] % 256, int(im.size[1] / 256))
-
-        sys.stdout.buffer.write(header + width_bytes + height_bytes + im.tobytes())
-    finally:
-        os.remove(image_path)
+    im = Image.open(BytesIO(png)).transpose(Image.FLIP_TOP_BOTTOM).convert('1')
+    width, height = im.size
+    row_bytes = (width + 7) // 8
+
+    # Mode '1' packs 1 as white; the printer wants 1 as a dot. Rows are
+    # already padded to whole bytes, but the padding bits must stay blank.
+    data = bytearray(im.tobytes().translate(INVERT_TABLE))
+    if width % 8:
+        mask = (0xFF << (8 - width % 8)) & 0xFF
+        data[row_bytes - 1::row_bytes] = data[row_bytes - 1::row_bytes].translate(bytes(b & mask for b in range(256)))
+
+    return RASTER_HEADER + struct.pack('<HH', row_bytes, height) + data
+
+def get_escpos_blob(svg_path, refresh=False):
+    """Returns the cached ESC-POS blob path for an SVG icon, rendering it on first use.
+
+    If the cache can't be written, the freshly rendered bytes are returned instead.
+    """
+    blob_path = get_cache_path(svg_path, ".escpos")
+    if refresh or not os.path.exists(blob_path):
+        blob = render_svg_to_escpos(svg_path)
+        try:
+            write_cache_file(blob_path, blob)
+        except OSError:
+            return blob
+    return blob_path
+
+def write_receipt(header, blob, footer):
+    """Writes the receipt to stdout, copying a cached icon blob with sendfile() where supported."""
+    stdout = sys.stdout.buffer
+    if isinstance(blob, bytes):
+        stdout.write(header + blob + footer)
+        stdout.flush()
+        return
+
+    stdout.write(header)
+    stdout.flush()
+    with open(blob, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(stdout.fileno(), f.fileno(), offset, size - offset)
+                if not sent:
+                    break
+                offset += sent
+        except (AttributeError, OSError):
+            # No sendfile() on this platform or for this output; copy the bytes instead.
+            if offset:
+                raise
+            stdout.write(f.read())
+    stdout.write(footer)
+    stdout.flush()
 
 def format_date_with_ordinal(d):
     """Formats date with ordinal suffix."""
-    day = d.day
-    if 4 <= day <= 20 or 24 <= day <= 30:
-        suffix = "th"
-    else:
-        suffix = ["st", "nd", "rd"][day % 10 - 1]
-    return d.strftime(f"%-d{suffix} %b %Y")
+    return d.strftime(f"%-d{ORDINAL_SUFFIXES[d.day]} %b %Y")
 
 def main():
     """Main script execution."""
@@ -178,22 +346,24 @@ def main():
     precip_hours = daily_data['precipitation_hours'][0]
 
     weather_icon_svg_path = get_weather_icon_path(weather_code)
-    weather_icon_png_path = convert_svg_to_png(weather_icon_svg_path)
-
-    sys.stdout.buffer.write(b'\x1b\x7b\x01')
-    sys.stdout.buffer.write(b'\x1d\x21\x11')
-    sys.stdout.buffer.write(b'\n')
-    sys.stdout.buffer.write(f"{precip_chance}% ({precip_hours}h)\n".encode("ascii"))
-    sys.stdout.buffer.write(f"Min: {temp_min}\n".encode("ascii"))
-    sys.stdout.buffer.write(f"Max: {temp_max}\n".encode("ascii"))
-
-    print_image_and_cleanup(weather_icon_png_path)
-
-    sys.stdout.buffer.write(b'\n')
-    sys.stdout.buffer.write(f"{format_date_with_ordinal(datetime.now())}\n".encode("ascii"))
-    sys.stdout.buffer.write(b'\x1d\x21\x00')
-    sys.stdout.buffer.write(b'\x1b\x7b\x00')
-    sys.stdout.buffer.write(b'\n\n\n')
+    weather_icon_blob = get_escpos_blob(weather_icon_svg_path)
+
+    header = bytearray()
+    header += b'\x1b\x7b\x01'
+    header += b'\x1d\x21\x11'
+    header += b'\n'
+    header += f"{precip_chance}% ({precip_hours}h)\n".encode("ascii")
+    header += f"Min: {temp_min}\n".encode("ascii")
+    header += f"Max: {temp_max}\n".encode("ascii")
+
+    footer = bytearray()
+    footer += b'\n'
+    footer += f"{format_date_with_ordinal(datetime.now())}\n".encode("ascii")
+    footer += b'\x1d\x21\x00'
+    footer += b'\x1b\x7b\x00'
+    footer += b'\n\n\n'
+
+    write_receipt(header, weather_icon_blob, footer)
 
 if __name__ == "__main__":
     main()